@@ -1,10 +1,18 @@
 import sqlite3
+import itertools
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# aggregate_sales sums directly over the SKU x day grid while it has at most this many cells per
+# sales row (or fewer than _DENSE_GRID_MIN_CELLS), bounding its memory to a small multiple of the input
+_DENSE_GRID_CELLS_PER_ROW = 4
+_DENSE_GRID_MIN_CELLS = 1 << 20
+
 def connect_db(db_path: str):
     """Connect to the SQLite database located at db_path."""
     try:
@@ -15,12 +23,39 @@ def connect_db(db_path: str):
         logging.error("Failed to connect to database: %s", e)
         raise 
 
+def create_sales_index(conn):
+    """Create an index on sales(sku_id, DATE(orderdate_utc)) to speed up the revenue join.
+
+    The indexed expression matches the join predicate of the revenue query, so SQLite can SEARCH
+    the index per product-date pair instead of scanning the sales table.
+    """
+    try:
+        logging.info("Creating index on sales table")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_sales_sku_date ON sales(sku_id, DATE(orderdate_utc))"
+        )
+    except sqlite3.Error as e:
+        logging.error("Error creating sales index: %s", e)
+        raise
+
 def load_data(conn):
-    """Load 'product' and 'sales' tables from the database into pandas DataFrames."""
+    """Load 'product' and 'sales' tables from the database into pandas DataFrames.
+
+    'sku_id' is stored as a category shared by both tables, and 'sales' is downcast to the
+    smallest integer type that holds it, to reduce memory moved by merges and groupings.
+    Sales rows of SKUs that are not in the product table are dropped.
+    """
     try:
         logging.info("Loading product and sales tables")
-        product_df = pd.read_sql_query("SELECT * FROM product", conn)
-        sales_df = pd.read_sql_query("SELECT * FROM sales", conn)
+        # Only the columns used by the pipeline are read
+        product_df = pd.read_sql_query("SELECT sku_id, price FROM product", conn)
+        sales_df = pd.read_sql_query("SELECT sku_id, orderdate_utc, sales FROM sales", conn)
+        product_df["sku_id"] = product_df["sku_id"].astype("category")
+        sku_categories = product_df["sku_id"].cat.categories
+        # Sales of unknown SKUs cannot reach the revenue table and have no category to map to
+        sales_df = sales_df[sales_df["sku_id"].isin(sku_categories)].reset_index(drop=True)
+        sales_df["sku_id"] = sales_df["sku_id"].astype(pd.CategoricalDtype(categories=sku_categories))
+        sales_df["sales"] = pd.to_numeric(sales_df["sales"], downcast="integer")
         return product_df, sales_df
     except Exception as e:
         logging.error("Error loading data from database: %s", e)
@@ -28,122 +63,248 @@ def load_data(conn):
 
 def preprocess_sales(sales_df):
     """Convert the 'orderdate_utc' column in sales DataFrame to datetime format."""
-    try:
-        logging.info("Preprocessing sales data")
-        sales_df["orderdate_utc"] = pd.to_datetime(sales_df["orderdate_utc"])
-        return sales_df
-    except Exception as e:
-        logging.error("Error preprocessing sales data: %s", e)
-        raise
+    logging.debug("Preprocessing sales data")
+    sales_df["orderdate_utc"] = pd.to_datetime(sales_df["orderdate_utc"])
+    return sales_df
 
 def create_date_range(start_date: datetime, end_date: datetime):
     """Create a daily date range from start_date to end_date inclusive."""
-    try:
-        logging.info("Creating date range from %s to %s", start_date, end_date)
-        return pd.date_range(start=start_date, end=end_date)
-    except Exception as e:
-        logging.error("Error creating date range: %s", e)
-        raise
+    logging.debug("Creating date range from %s to %s", start_date, end_date)
+    return pd.date_range(start=start_date, end=end_date)
 
 def generate_all_combinations(product_df, date_range):
     """Generate all possible combinations of product SKUs and dates.
 
     This simulates a CROSS JOIN between products and dates to get every SKU for each date in the range.
+    Rows are ordered by SKU first, then by date, which is the final order of the revenue table.
     """
-    try:
-        logging.info("Generating all product-date combinations")
-        all_combinations = pd.MultiIndex.from_product(
-            [product_df["sku_id"], date_range],
-            names=["sku_id", "date_id"]
-        ).to_frame(index=False)
-        return all_combinations
-    except Exception as e:
-        logging.error("Error generating all combinations: %s", e)
-        raise
+    logging.debug("Generating all product-date combinations")
+    n_dates = len(date_range)
+    n_skus = len(product_df)
+    all_combinations = pd.DataFrame({
+        "sku_id": np.repeat(product_df["sku_id"].sort_values().values, n_dates),
+        "date_id": np.tile(date_range.values, n_skus),
+    })
+    return all_combinations
 
 
 def aggregate_sales(sales_df):
     """Aggregate sales by sku_id and date (sum the 'sales' column).
 
     Extract the date part from 'orderdate_utc' and group sales accordingly.
+    Each (sku_id, day) pair is encoded as one int64 key (SKU code * number of days + day offset),
+    and sales are summed per key with np.bincount. When the SKU x day grid is small relative to
+    the number of rows, the keys index the grid directly; otherwise they are factorized first.
     """
-    try:
-        logging.info("Aggregating sales data")
-        agg_sales = (
-            sales_df
-            .assign(date_id=sales_df["orderdate_utc"].dt.date)  # Extract date part only
-            .groupby(["sku_id", "date_id"], as_index=False)["sales"]
-            .sum()
-        )
-        # Convert 'date_id' back to datetime for consistency with all_combinations
-        agg_sales['date_id'] = pd.to_datetime(agg_sales['date_id'])
-        return agg_sales
-    except Exception as e:
-        logging.error("Error aggregating sales: %s", e)
-        raise
+    logging.debug("Aggregating sales data")
+    # Sales without a date or a value, or of SKUs missing from the product categories, cannot appear in the revenue table
+    sales_df = sales_df[
+        sales_df["sku_id"].notna() & sales_df["orderdate_utc"].notna() & sales_df["sales"].notna()
+    ]
+    order_dates = sales_df["orderdate_utc"].values
+    # Truncate to the day on the underlying datetime64 array, as whole days since the epoch
+    day_ints = order_dates.astype("datetime64[D]").astype(np.int64)
+    first_day = day_ints.min() if len(day_ints) else 0
+    n_days = day_ints.max() - first_day + 1 if len(day_ints) else 1
+    sku_codes, sku_uniques = pd.factorize(sales_df["sku_id"], sort=True)
+    group_keys = sku_codes * n_days + (day_ints - first_day)
+    sales_values = sales_df["sales"].values
+
+    # np.bincount sums the weights in float64, which is exact for integer totals up to 2**53
+    grid_size = len(sku_uniques) * n_days
+    if grid_size <= max(_DENSE_GRID_CELLS_PER_ROW * len(group_keys), _DENSE_GRID_MIN_CELLS):
+        counts = np.bincount(group_keys, minlength=grid_size)
+        groups = np.flatnonzero(counts)  # Sorted keys that have at least one sale row
+        sales_sum = np.bincount(group_keys, weights=sales_values, minlength=grid_size)[groups]
+    else:
+        # Sparse sales over a wide SKU x day grid: number only the keys that occur
+        group_codes, groups = pd.factorize(group_keys, sort=True)
+        sales_sum = np.bincount(group_codes, weights=sales_values, minlength=len(groups))
+
+    return pd.DataFrame({
+        "sku_id": sku_uniques.take(groups // n_days),  # Keeps the categorical dtype of SKUs
+        "date_id": (groups % n_days + first_day).astype("datetime64[D]").astype(order_dates.dtype),
+        "sales": sales_sum.astype(np.int64),  # Exact float64 sums back to int64; downcast input cannot overflow
+    })
 
 def build_revenue_table(all_combinations, product_df, agg_sales):
     """Build the final revenue DataFrame by combining products, dates, prices, and sales.
 
     Steps:
-    - Merge all SKU-date combos with product prices
-    - Merge the result with aggregated sales data (left join to keep all combos)
-    - Fill missing sales with zero
+    - Merge all SKU-date combos with product prices (left join to keep all combos)
+    - Scatter aggregated sales into a zero-initialised int64 column at their (sku_id, date_id) rows,
+      so combos without sales are 0 without a NaN/float round trip
     - Calculate revenue as price * sales
-    - Sort results and format date for output
+    - Sort results (only if the combos were not already in SKU-date order) and format date for output
     """
-    try:
-        logging.info("Building revenue table")
-        
-        revenue_df = all_combinations.merge(product_df[["sku_id", "price"]], on="sku_id", how="left")
-        revenue_df['date_id'] = pd.to_datetime(revenue_df['date_id'])
-        
-        revenue_df = revenue_df.merge(agg_sales, on=["sku_id", "date_id"], how="left")
-        revenue_df["sales"] = revenue_df["sales"].fillna(0).astype(int)  # Replace NaN sales with 0
-        revenue_df["revenue"] = revenue_df["price"] * revenue_df["sales"]
-        
+    logging.debug("Building revenue table")
+    
+    # date_id is datetime64 by construction in generate_all_combinations and aggregate_sales
+    assert all_combinations["date_id"].dtype.kind == "M", "all_combinations.date_id must be datetime64"
+    revenue_df = all_combinations.merge(
+        product_df[["sku_id", "price"]], on="sku_id", how="left", validate="m:1"
+    )
+    
+    # Row position of each aggregated (sku_id, date_id) pair, -1 if it is not a combo
+    sales_rows = pd.MultiIndex.from_frame(revenue_df[["sku_id", "date_id"]]).get_indexer(
+        pd.MultiIndex.from_frame(agg_sales[["sku_id", "date_id"]])
+    )
+    matched = sales_rows >= 0
+    sales = np.zeros(len(revenue_df), dtype=np.int64)
+    sales[sales_rows[matched]] = agg_sales["sales"].values[matched]
+    revenue_df["sales"] = sales
+    # Multiply straight into a preallocated float64 array to avoid a temporary result column
+    revenue = np.empty(len(revenue_df), dtype=np.float64)
+    np.multiply(revenue_df["price"].values, revenue_df["sales"].values, out=revenue)
+    revenue_df["revenue"] = revenue
+    
+    # Left joins keep the order of all_combinations, which is usually already sorted
+    if not pd.MultiIndex.from_arrays([revenue_df["sku_id"], revenue_df["date_id"]]).is_monotonic_increasing:
         revenue_df = revenue_df.sort_values(["sku_id", "date_id"])
-        revenue_df["date_id"] = revenue_df["date_id"].astype(str)  # Convert date to string for display
-        
-        return revenue_df
+    revenue_df["date_id"] = revenue_df["date_id"].dt.strftime("%Y-%m-%d")  # ISO date string, stored as TEXT
     
+    return revenue_df
+
+def build_revenue_query(date_range):
+    """Build the SQL query that computes the revenue table inside SQLite.
+
+    The dates are supplied as a VALUES CTE (one bound parameter per day), cross joined with
+    every product and left joined with sales, so only the final revenue rows reach Python.
+    Returns the query string and its parameters.
+    """
+    logging.debug("Building revenue query for %d dates", len(date_range))
+    values = ", ".join(["(?)"] * len(date_range))
+    query = f"""
+        WITH dates(date_id) AS (VALUES {values})
+        SELECT
+            p.sku_id,
+            d.date_id,
+            p.price,
+            COALESCE(SUM(s.sales), 0) AS sales,
+            p.price * COALESCE(SUM(s.sales), 0) AS revenue
+        FROM product p
+        CROSS JOIN dates d
+        LEFT JOIN sales s
+            ON s.sku_id = p.sku_id AND DATE(s.orderdate_utc) = d.date_id
+        GROUP BY p.sku_id, d.date_id
+        ORDER BY p.sku_id, d.date_id
+    """
+    params = list(date_range.strftime("%Y-%m-%d"))
+    return query, params
+
+def query_revenue(conn, date_range):
+    """Compute the revenue DataFrame with a single aggregated query executed by SQLite."""
+    try:
+        logging.info("Querying revenue table from database")
+        query, params = build_revenue_query(date_range)
+        return pd.read_sql_query(query, conn, params=params)
     except Exception as e:
-        logging.error("Error building revenue table: %s", e)
+        logging.error("Error querying revenue table: %s", e)
         raise
 
-def save_revenue_to_db(revenue_df, conn):
-    """Save the revenue DataFrame into the SQLite database as a new 'revenue' table."""
+def configure_bulk_write(conn):
+    """Tune SQLite PRAGMAs for a bulk write: WAL journal, relaxed fsync, in-memory temp storage and a 64 MB page cache.
+
+    Call once per connection, before any writes. The WAL journal mode is stored in the database
+    file, so it stays on for every later connection to that database.
+    """
+    try:
+        logging.info("Configuring database for bulk write")
+        if conn.in_transaction:
+            # SQLite refuses to change the synchronous level inside a transaction
+            raise sqlite3.OperationalError(
+                "configure_bulk_write must be called outside a transaction; commit or roll back first"
+            )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+    except sqlite3.Error as e:
+        logging.error("Error configuring database for bulk write: %s", e)
+        raise
+
+@contextmanager
+def _rebuilding_revenue_table(conn):
+    """Recreate the 'revenue' table and yield a cursor to fill it, all as one atomic unit.
+
+    sqlite3 does not open a transaction before DDL, so the DROP/CREATE would otherwise commit on
+    their own and a failed fill would leave the old table gone. Without an open transaction this
+    owns one (BEGIN ... COMMIT/ROLLBACK); inside the caller's transaction it uses a SAVEPOINT, so
+    only the rebuild is undone on error and committing stays up to the caller.
+    """
+    owns_transaction = not conn.in_transaction
+    cur = conn.cursor()
+    cur.execute("BEGIN" if owns_transaction else "SAVEPOINT revenue_rebuild")
+    try:
+        cur.execute("DROP TABLE IF EXISTS revenue")
+        cur.execute("CREATE TABLE revenue (sku_id INTEGER, date_id TEXT, price REAL, sales INTEGER, revenue REAL)")
+        yield cur
+    except BaseException:
+        if conn.in_transaction:
+            if owns_transaction:
+                cur.execute("ROLLBACK")
+            else:
+                cur.execute("ROLLBACK TO revenue_rebuild")
+                cur.execute("RELEASE revenue_rebuild")
+        raise
+    cur.execute("COMMIT" if owns_transaction else "RELEASE revenue_rebuild")
+
+def save_revenue_to_db(revenue_df, conn, chunksize: int = 50_000):
+    """Save the revenue DataFrame into the SQLite database as a new 'revenue' table.
+
+    Rows are streamed in chunks of `chunksize` through a prepared INSERT with executemany,
+    all inside a single transaction, so peak memory stays bounded for large tables.
+    """
     try:
         logging.info("Saving revenue table to database")
-        revenue_df[["sku_id", "date_id", "price", "sales", "revenue"]].to_sql("revenue", conn, if_exists="replace", index=False)
+        rows = revenue_df[["sku_id", "date_id", "price", "sales", "revenue"]].itertuples(index=False, name=None)
+        with _rebuilding_revenue_table(conn) as cur:
+            while True:
+                chunk = list(itertools.islice(rows, chunksize))
+                if not chunk:
+                    break
+                cur.executemany("INSERT INTO revenue VALUES (?, ?, ?, ?, ?)", chunk)
     except Exception as e:
         logging.error("Error saving revenue table to database: %s", e)
         raise
 
+def create_revenue_table_in_db(conn, date_range):
+    """Create the 'revenue' table directly from the revenue query with INSERT ... SELECT.
+
+    The rows are produced and written by SQLite in a single transaction, so none of them cross into Python.
+    """
+    try:
+        logging.info("Creating revenue table in database")
+        query, params = build_revenue_query(date_range)
+        with _rebuilding_revenue_table(conn) as cur:
+            cur.execute("INSERT INTO revenue " + query, params)
+    except Exception as e:
+        logging.error("Error creating revenue table in database: %s", e)
+        raise
+
 def main():
     db_path = "/path/to/your/product_sales.db"
     
     try:
         conn = connect_db(db_path)
-        product_df, sales_df = load_data(conn)
-        sales_df = preprocess_sales(sales_df)
+        configure_bulk_write(conn)
+        create_sales_index(conn)
         
         # Define the date range for January 2025
         start_date = datetime(2025, 1, 1)
         end_date = datetime(2025, 1, 31)
         date_range = create_date_range(start_date, end_date)
         
-        all_combinations = generate_all_combinations(product_df, date_range)
-        agg_sales = aggregate_sales(sales_df)
-        revenue_df = build_revenue_table(all_combinations, product_df, agg_sales)
+        # Cross join, aggregation, revenue calculation and the write all run inside SQLite
+        create_revenue_table_in_db(conn, date_range)
         
-        print(revenue_df.head())  # Print first few rows of the result for quick inspection
+        # Print first few rows of the result for quick inspection
+        print(pd.read_sql_query("SELECT * FROM revenue ORDER BY sku_id, date_id LIMIT 5", conn))
         
-        save_revenue_to_db(revenue_df, conn)
         conn.close()
         logging.info("Process completed successfully")
-    except Exception as e:
-        logging.error("An error occurred during processing: %s", e)
+    except Exception:
+        logging.exception("An error occurred during processing")
     finally:
         if 'conn' in locals():
             conn.close()
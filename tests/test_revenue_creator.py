@@ -1,5 +1,6 @@
 import unittest
 from unittest.mock import MagicMock, patch
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import sqlite3
@@ -7,6 +8,42 @@ import revenue_creator
 
 class TestDataPipeline(unittest.TestCase):
 
+    OLD_REVENUE_ROW = (1, "2024-12-31", 10.0, 1, 10.0)
+
+    # Create an in-memory database with committed product and sales tables holding the given rows
+    def create_db(self, products=(), sales=()):
+        conn = sqlite3.connect(":memory:")
+        self.addCleanup(conn.close)
+        conn.execute("CREATE TABLE product (sku_id INTEGER, price REAL)")
+        conn.execute("CREATE TABLE sales (sku_id INTEGER, orderdate_utc TEXT, sales INTEGER)")
+        conn.executemany("INSERT INTO product VALUES (?, ?)", products)
+        conn.executemany("INSERT INTO sales VALUES (?, ?, ?)", sales)
+        conn.commit()
+        return conn
+
+    # Add a committed revenue table holding OLD_REVENUE_ROW, to check that failed writes keep it
+    def create_old_revenue_table(self, conn):
+        conn.execute("CREATE TABLE revenue (sku_id INTEGER, date_id TEXT, price REAL, sales INTEGER, revenue REAL)")
+        conn.execute("INSERT INTO revenue VALUES (?, ?, ?, ?, ?)", self.OLD_REVENUE_ROW)
+        conn.commit()
+
+    # Test if load_data shares sku_id categories between tables and downcast sales still aggregate without overflow
+    def test_load_data(self):
+        conn = self.create_db(
+            products=[(1, 10.0), (2, 2.5)],
+            sales=[
+                (1, "2025-01-01 10:00:00", 100),
+                (1, "2025-01-01 15:00:00", 100),
+                (3, "2025-01-01 12:00:00", 7),  # Unknown SKU
+            ],
+        )
+        product_df, sales_df = revenue_creator.load_data(conn)
+        self.assertEqual(product_df["sku_id"].dtype, "category")
+        self.assertEqual(sales_df["sku_id"].dtype, product_df["sku_id"].dtype)
+        self.assertEqual(sales_df["sales"].dtype, "int8")
+        result = revenue_creator.aggregate_sales(revenue_creator.preprocess_sales(sales_df))
+        self.assertListEqual(list(result["sales"]), [200])  # Summed past int8 range, unknown SKU dropped
+
     # Test if create_date_range correctly generates a range of dates between start_date and end_date
     def test_create_date_range(self):
         start_date = datetime(2025, 1, 1)
@@ -24,6 +61,14 @@ class TestDataPipeline(unittest.TestCase):
         self.assertEqual(len(result), expected_rows)
         self.assertListEqual(list(result.columns), ["sku_id", "date_id"])
 
+    # Test if generate_all_combinations emits rows in SKU-date order even when products are unsorted
+    def test_generate_all_combinations_sorted(self):
+        product_df = pd.DataFrame({"sku_id": [2, 1]})
+        date_list = pd.date_range("2025-01-01", "2025-01-02")
+        result = revenue_creator.generate_all_combinations(product_df, date_list)
+        self.assertListEqual(list(result["sku_id"]), [1, 1, 2, 2])
+        self.assertListEqual(list(result["date_id"]), list(date_list) * 2)
+
     # Test if aggregate_sales correctly sums sales for each product per day
     def test_aggregate_sales(self):
         data = {
@@ -37,6 +82,37 @@ class TestDataPipeline(unittest.TestCase):
         self.assertEqual(result.loc[result["sku_id"] == 1, "sales"].values[0], 5)  # 2+3=5 sales for sku 1 on 1 Jan
         self.assertEqual(result.loc[result["sku_id"] == 2, "sales"].values[0], 5)
 
+    # Test if aggregate_sales skips NULL sales values instead of corrupting the daily sum
+    def test_aggregate_sales_null_sales(self):
+        sales_df = pd.DataFrame({
+            "sku_id": [1, 1],
+            "orderdate_utc": pd.to_datetime(["2025-01-01 10:00:00", "2025-01-01 15:00:00"]),
+            "sales": [None, 3],
+        })
+        result = revenue_creator.aggregate_sales(sales_df)
+        self.assertListEqual(list(result["sales"]), [3])
+
+    # Test if aggregate_sales matches groupby when sales are sparse over a wide SKU x day grid (factorized keys)
+    def test_aggregate_sales_sparse_grid(self):
+        rng = np.random.default_rng(0)
+        n_rows = 2000
+        sales_df = pd.DataFrame({
+            "sku_id": rng.integers(0, 200, n_rows),
+            "orderdate_utc": pd.Timestamp("1985-01-01")
+            + pd.to_timedelta(rng.integers(0, 40 * 365 * 86400, n_rows), unit="s"),
+            "sales": rng.integers(0, 10, n_rows),
+        })
+        # 200 SKUs x ~14600 days exceeds the dense grid limit for 2000 rows, so the keys are factorized
+        self.assertGreater(200 * 40 * 365, revenue_creator._DENSE_GRID_MIN_CELLS)
+        result = revenue_creator.aggregate_sales(sales_df)
+        expected = (
+            sales_df
+            .assign(date_id=sales_df["orderdate_utc"].dt.floor("D"))
+            .groupby(["sku_id", "date_id"], as_index=False)["sales"]
+            .sum()
+        )
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
     # Test if build_revenue_table correctly calculates revenue by multiplying price and sales
     def test_build_revenue_table(self):
         product_df = pd.DataFrame({"sku_id": [1], "price": [10]})
@@ -47,6 +123,141 @@ class TestDataPipeline(unittest.TestCase):
         self.assertIn("revenue", result.columns)
         self.assertEqual(result.loc[0, "revenue"], 30)  # 10 price * 3 sales
 
+    # Test if build_revenue_table zero-fills unsold combos and drops aggregated sales outside the combos,
+    # for the categorical sku_id that load_data produces as well as plain integer combos
+    def test_build_revenue_table_zero_fill(self):
+        conn = self.create_db(
+            products=[(3, 1.5), (1, 10.0), (2, 2.5)],
+            sales=[
+                (1, "2025-01-01 10:00:00", 2),
+                (1, "2025-01-03 23:59:59", 3),
+                (3, "2025-01-02 08:00:00", 4),
+                (2, "2025-01-05 12:00:00", 7),  # Outside the date range
+            ],
+        )
+        product_df, sales_df = revenue_creator.load_data(conn)
+        date_list = pd.date_range("2025-01-01", "2025-01-03")
+        agg_sales = revenue_creator.aggregate_sales(revenue_creator.preprocess_sales(sales_df))
+        self.assertEqual(agg_sales["sku_id"].dtype, "category")
+        expected_sales = [2, 0, 3, 0, 0, 0, 0, 4, 0]  # SKU 2 only sold outside the range
+        expected_revenue = [20.0, 0.0, 30.0, 0.0, 0.0, 0.0, 0.0, 6.0, 0.0]
+
+        result = revenue_creator.build_revenue_table(
+            revenue_creator.generate_all_combinations(product_df, date_list), product_df, agg_sales
+        )
+        self.assertListEqual(list(result["sku_id"]), [1, 1, 1, 2, 2, 2, 3, 3, 3])
+        self.assertListEqual(list(result["sales"]), expected_sales)
+        self.assertListEqual(list(result["revenue"]), expected_revenue)
+
+        # Integer combos and prices against the categorical aggregated sales
+        int_product_df = product_df.astype({"sku_id": "int64"})
+        result = revenue_creator.build_revenue_table(
+            revenue_creator.generate_all_combinations(int_product_df, date_list), int_product_df, agg_sales
+        )
+        self.assertListEqual(list(result["sales"]), expected_sales)
+        self.assertListEqual(list(result["revenue"]), expected_revenue)
+
+    # Test if query_revenue computes the same revenue table inside SQLite as the pandas pipeline
+    def test_query_revenue(self):
+        conn = self.create_db(
+            products=[(1, 10.0), (2, 2.5)],
+            sales=[
+                (1, "2025-01-01 10:00:00", 2),
+                (1, "2025-01-01 15:00:00", 3),
+                (2, "2025-01-02 12:00:00", 4),
+            ],
+        )
+        date_list = pd.date_range("2025-01-01", "2025-01-02")
+        result = revenue_creator.query_revenue(conn, date_list)
+        self.assertListEqual(list(result.columns), ["sku_id", "date_id", "price", "sales", "revenue"])
+        self.assertListEqual(list(result["date_id"]), ["2025-01-01", "2025-01-02"] * 2)
+        self.assertListEqual(list(result["sales"]), [5, 0, 0, 4])  # Days without sales are filled with 0
+        self.assertListEqual(list(result["revenue"]), [50.0, 0.0, 0.0, 10.0])
+
+    # Test if create_sales_index lets the revenue query search sales by index instead of scanning it
+    def test_create_sales_index(self):
+        conn = self.create_db()
+        revenue_creator.create_sales_index(conn)
+        query, params = revenue_creator.build_revenue_query(pd.date_range("2025-01-01", "2025-01-02"))
+        plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params))
+        self.assertIn("SEARCH s USING INDEX ix_sales_sku_date", plan)
+
+    # Test if save_revenue_to_db writes every row of the revenue table to the database
+    def test_save_revenue_to_db(self):
+        conn = self.create_db()
+        revenue_df = pd.DataFrame({
+            "sku_id": [1, 1, 2],
+            "date_id": ["2025-01-01", "2025-01-02", "2025-01-01"],
+            "price": [10.0, 10.0, 2.5],
+            "sales": [3, 0, 4],
+            "revenue": [30.0, 0.0, 10.0],
+        })
+        revenue_creator.save_revenue_to_db(revenue_df, conn, chunksize=2)  # Forces more than one chunk
+        rows = conn.execute("SELECT * FROM revenue ORDER BY sku_id, date_id").fetchall()
+        self.assertListEqual(rows, [(1, "2025-01-01", 10.0, 3, 30.0), (1, "2025-01-02", 10.0, 0, 0.0), (2, "2025-01-01", 2.5, 4, 10.0)])
+
+    # Test if a failure in a later chunk of save_revenue_to_db leaves the existing revenue table untouched
+    def test_save_revenue_to_db_failure_keeps_old_table(self):
+        conn = self.create_db()
+        self.create_old_revenue_table(conn)
+        revenue_df = pd.DataFrame({
+            "sku_id": [1, 1, 2],
+            "date_id": ["2025-01-01", "2025-01-02", ["not", "bindable"]],  # Fails in the second chunk
+            "price": [10.0, 10.0, 2.5],
+            "sales": [3, 0, 4],
+            "revenue": [30.0, 0.0, 10.0],
+        })
+        with self.assertRaises(sqlite3.Error):
+            revenue_creator.save_revenue_to_db(revenue_df, conn, chunksize=2)
+        rows = conn.execute("SELECT * FROM revenue").fetchall()
+        self.assertListEqual(rows, [self.OLD_REVENUE_ROW])
+
+    # Test if save_revenue_to_db joins a caller's open transaction instead of failing or committing it
+    def test_save_revenue_to_db_inside_transaction(self):
+        conn = self.create_db()
+        conn.execute("INSERT INTO sales VALUES (1, '2025-01-01 10:00:00', 2)")  # Left uncommitted
+        revenue_df = pd.DataFrame({
+            "sku_id": [1], "date_id": ["2025-01-01"], "price": [10.0], "sales": [2], "revenue": [20.0],
+        })
+        revenue_creator.save_revenue_to_db(revenue_df, conn)
+        self.assertTrue(conn.in_transaction)  # Committing is still up to the caller
+        conn.commit()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM sales").fetchone()[0], 1)
+        self.assertListEqual(conn.execute("SELECT * FROM revenue").fetchall(), [(1, "2025-01-01", 10.0, 2, 20.0)])
+
+    # Test if configure_bulk_write refuses to run inside an open transaction with a clear error
+    def test_configure_bulk_write_inside_transaction(self):
+        conn = self.create_db()
+        conn.execute("INSERT INTO sales VALUES (1, '2025-01-01 10:00:00', 2)")  # Left uncommitted
+        with self.assertRaisesRegex(sqlite3.OperationalError, "outside a transaction"):
+            revenue_creator.configure_bulk_write(conn)
+
+    # Test if create_revenue_table_in_db writes the same rows as query_revenue returns
+    def test_create_revenue_table_in_db(self):
+        conn = self.create_db(
+            products=[(1, 10.0), (2, 2.5)],
+            sales=[
+                (1, "2025-01-01 10:00:00", 2),
+                (2, "2025-01-02 12:00:00", 4),
+            ],
+        )
+        date_list = pd.date_range("2025-01-01", "2025-01-02")
+        revenue_creator.create_revenue_table_in_db(conn, date_list)
+        result = pd.read_sql_query("SELECT * FROM revenue ORDER BY sku_id, date_id", conn)
+        expected = revenue_creator.query_revenue(conn, date_list)
+        pd.testing.assert_frame_equal(result, expected)
+
+    # Test if a failed create_revenue_table_in_db leaves the existing revenue table untouched
+    def test_create_revenue_table_in_db_failure_keeps_old_table(self):
+        conn = self.create_db()
+        self.create_old_revenue_table(conn)
+        conn.execute("DROP TABLE product")
+        conn.commit()
+        with self.assertRaises(sqlite3.OperationalError):  # No such table: product
+            revenue_creator.create_revenue_table_in_db(conn, pd.date_range("2025-01-01", "2025-01-02"))
+        rows = conn.execute("SELECT * FROM revenue").fetchall()
+        self.assertListEqual(rows, [self.OLD_REVENUE_ROW])
+
     # Test successful database connection with a mock sqlite3.connect
     @patch('revenue_creator.sqlite3.connect')
     def test_connect_db_success(self, mock_connect):